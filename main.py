@@ -3,18 +3,26 @@ FastAPI Proxy for Ollama with Token Authentication
 Supports multiple Ollama instances on different ports
 """
 
+import hmac
+import ipaddress
 import os
-from dotenv import load_dotenv
+import socket
 
-# Load environment variables from .env file
-load_dotenv()
+# Load environment variables from .env file (only when one exists, e.g. local runs;
+# containers get their environment directly)
+ENV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+if os.path.exists(ENV_FILE):
+    from dotenv import load_dotenv
+    load_dotenv(ENV_FILE)
 
 import httpx
-from fastapi import FastAPI, Request, HTTPException, Depends, Header
-from fastapi.responses import StreamingResponse, JSONResponse
+import anyio
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import JSONResponse
+from starlette.requests import ClientDisconnect
 from typing import Optional, Dict, List
 import logging
-import json
+import orjson
 
 # Setup logging with debug support
 DEBUG_MODE = os.getenv("DEBUG", "false").lower() == "true"
@@ -42,6 +50,7 @@ app = FastAPI(
 
 # Configuration
 API_TOKEN = os.getenv("API_TOKEN", "")
+API_TOKEN_BYTES = API_TOKEN.encode()
 if not API_TOKEN:
     logger.warning("⚠️  API_TOKEN not set! Authentication is disabled.")
 else:
@@ -53,32 +62,99 @@ else:
 OLLAMA_INSTANCES = os.getenv("OLLAMA_INSTANCES", "default:localhost:11434")
 logger.debug(f"📝 Raw OLLAMA_INSTANCES config: {OLLAMA_INSTANCES}")
 
-# Parse Ollama instances
+# Resolve backend hostnames once at startup so reconnects skip DNS lookups.
+# Disable if backend addresses can change while the proxy runs (e.g. recreated containers)
+PIN_BACKEND_DNS = os.getenv("PIN_BACKEND_DNS", "true").lower() == "true"
+
+def resolve_host(host: str) -> str:
+    """Return the IPv4 address for a backend host, or the host itself if it can't be pinned"""
+    if not PIN_BACKEND_DNS:
+        return host
+    if host == "localhost":
+        # Skip the IPv6/IPv4 dual-stack attempts for the common local setup
+        return "127.0.0.1"
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+    try:
+        address = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)[0][4][0]
+        logger.debug(f"  📌 Pinned backend host '{host}' -> {address}")
+        return address
+    except OSError as e:
+        logger.warning(f"⚠️  Could not resolve backend host '{host}', keeping hostname: {e}")
+        return host
+
+# Configured host:port per instance, forwarded as the Host header when its address is
+# pinned so name-based virtual hosts and reverse proxies in front of a backend still match
+BACKEND_HOSTS: Dict[str, bytes] = {}
+
+def backend_url(name: str, host: str, port: str) -> str:
+    """Build the backend URL for an instance, remembering its Host header if the host was pinned"""
+    address = resolve_host(host)
+    if address != host:
+        BACKEND_HOSTS[name] = f"{host}:{port}".encode()
+    return f"http://{address}:{port}/"
+
+# Parse Ollama instances (URLs keep a trailing slash so request paths can be appended directly)
 def parse_ollama_instances() -> Dict[str, str]:
     instances = {}
     for instance_config in OLLAMA_INSTANCES.split(","):
         parts = instance_config.strip().split(":")
         if len(parts) == 3:
             name, host, port = parts
-            instances[name] = f"http://{host}:{port}"
+            instances[name] = backend_url(name, host, port)
             logger.debug(f"  ➕ Parsed instance '{name}' -> {instances[name]}")
         elif len(parts) == 2:
             # Assume localhost if only name:port given
             name, port = parts
-            instances[name] = f"http://localhost:{port}"
+            instances[name] = backend_url(name, "localhost", port)
             logger.debug(f"  ➕ Parsed instance '{name}' -> {instances[name]} (localhost assumed)")
     return instances
 
 BACKENDS = parse_ollama_instances()
-DEFAULT_BACKEND = list(BACKENDS.values())[0] if BACKENDS else "http://localhost:11434"
+DEFAULT_BACKEND = next(iter(BACKENDS.values()), f"http://{resolve_host('localhost')}:11434/")
+DEFAULT_BACKEND_HOST = BACKEND_HOSTS.get(next(iter(BACKENDS), None))
+
+# Headers that are not forwarded (matched as raw lowercase bytes)
+_REQ_DROP = frozenset({b"host", b"authorization"})
+# content-encoding is kept because response bodies are forwarded undecoded
+_RESP_DROP = frozenset({b"content-length", b"transfer-encoding", b"connection"})
 
 logger.info(f"📦 Configured backends: {BACKENDS}")
 logger.info(f"🎯 Default backend: {DEFAULT_BACKEND}")
 
 
+@app.on_event("startup")
+async def startup():
+    """Create the shared HTTP client so backend connections are kept alive and reused"""
+    app.state.client = httpx.AsyncClient(
+        timeout=httpx.Timeout(300.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=100,
+            max_connections=200,
+            keepalive_expiry=60.0
+        ),
+        # Backends are plain http://, where httpx only speaks HTTP/1.1 (h2 needs TLS ALPN)
+        http2=False
+    )
+    # Response bodies are forwarded undecoded, so only the client's own
+    # Accept-Encoding may reach the backend (not httpx's gzip/deflate default)
+    app.state.client.headers.pop("accept-encoding", None)
+    logger.debug("🔌 Shared HTTP client created")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Close the shared HTTP client and its pooled connections"""
+    await app.state.client.aclose()
+    logger.debug("🔌 Shared HTTP client closed")
+
+
 async def verify_token(authorization: Optional[str] = Header(None)):
     """Verify the API token from the Authorization header"""
-    if not API_TOKEN:
+    if not API_TOKEN_BYTES:
         # If no token is configured, allow all requests (dev mode)
         logger.debug("🔓 No API_TOKEN configured - allowing request")
         return True
@@ -92,10 +168,12 @@ async def verify_token(authorization: Optional[str] = Header(None)):
         )
     
     # Support both "Bearer <token>" and just "<token>"
-    token = authorization.replace("Bearer ", "").strip()
-    logger.debug(f"🔐 Validating token: {token[:4]}...{token[-4:] if len(token) > 8 else '***'}")
+    token = authorization[7:] if authorization.startswith("Bearer ") else authorization
+    token = token.strip()
+    if DEBUG_MODE:
+        logger.debug(f"🔐 Validating token: {token[:4]}...{token[-4:] if len(token) > 8 else '***'}")
     
-    if token != API_TOKEN:
+    if not hmac.compare_digest(token.encode(), API_TOKEN_BYTES):
         logger.warning("⛔ Invalid authentication token provided")
         raise HTTPException(
             status_code=403,
@@ -108,11 +186,11 @@ async def verify_token(authorization: Optional[str] = Header(None)):
 
 def get_backend_url(instance_name: Optional[str] = None) -> str:
     """Get the backend URL for the specified instance or default"""
-    if instance_name and instance_name in BACKENDS:
-        backend = BACKENDS[instance_name]
-        logger.debug(f"🎯 Selected backend '{instance_name}': {backend}")
+    backend = BACKENDS.get(instance_name) if instance_name else None
+    if backend is not None:
+        logger.debug("🎯 Selected backend '%s': %s", instance_name, backend)
         return backend
-    logger.debug(f"🎯 Using default backend: {DEFAULT_BACKEND}")
+    logger.debug("🎯 Using default backend: %s", DEFAULT_BACKEND)
     return DEFAULT_BACKEND
 
 
@@ -133,211 +211,234 @@ async def health():
     return {"status": "healthy"}
 
 
-@app.api_route("/{instance}/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
-async def proxy_with_instance(
-    instance: str,
-    path: str,
-    request: Request,
-    authenticated: bool = Depends(verify_token)
-):
-    """
-    Proxy requests to specific Ollama instance OR to default if instance name not recognized
-    Example: /ollama1/api/tags -> routes to ollama1 backend
-    Example: /api/tags -> routes to default backend as /api/tags (if 'api' is not an instance name)
+def resolve_target(path: str):
     """
-    # Check if the first segment is actually an instance name
-    if instance in BACKENDS:
-        logger.debug(f"📨 Received request for instance '{instance}', path: {path}")
-        backend_url = BACKENDS[instance]
-        target_url = f"{backend_url}/{path}"
-        return await proxy_request(request, target_url, instance)
-    else:
-        # Treat the entire path including 'instance' as the path to default backend
-        logger.debug(f"📨 '{instance}' is not an instance name, treating as path segment")
-        full_path = f"{instance}/{path}" if path else instance
-        logger.debug(f"📨 Routing to default backend with full path: {full_path}")
-        target_url = f"{DEFAULT_BACKEND}/{full_path}"
-        return await proxy_request(request, target_url, "default")
-
-
-@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
-async def proxy_default(
-    path: str,
-    request: Request,
-    authenticated: bool = Depends(verify_token)
-):
+    Map an incoming path to (instance_name, target_url, host_header)
+    Example: /ollama1/api/tags -> ollama1 backend, api/tags
+    Example: /api/tags -> default backend, api/tags (if 'api' is not an instance name)
     """
-    Proxy requests to default Ollama instance
-    Example: /api/tags -> routes to default backend
-    """
-    # Skip root and health endpoints
-    if path in ["", "health"]:
-        logger.debug(f"📍 Health check endpoint accessed: {path}")
-        return {"status": "ok"}
+    instance, separator, rest = path[1:].partition("/")
+    if separator:
+        # Check if the first segment is actually an instance name
+        backend = BACKENDS.get(instance)
+        if backend is not None:
+            logger.debug("📨 Received request for instance '%s', path: %s", instance, rest)
+            return instance, backend + rest, BACKEND_HOSTS.get(instance)
     
-    logger.debug(f"📨 Received request for default instance, path: {path}")
-    target_url = f"{DEFAULT_BACKEND}/{path}"
-    return await proxy_request(request, target_url, "default")
+    # Treat the entire path as the path to default backend
+    logger.debug("📨 Routing to default backend with full path: %s", path[1:])
+    return "default", DEFAULT_BACKEND + path[1:], DEFAULT_BACKEND_HOST
 
 
-async def proxy_request(request: Request, target_url: str, instance_name: str = "unknown"):
+async def proxy_asgi(scope, receive, send):
     """
-    Forward the request to the target Ollama instance
-    Handles both streaming and non-streaming responses
+    Raw ASGI app that forwards every request not handled by a FastAPI route
+    Bytes are piped receive -> backend -> send without building Request/Response objects
     """
+    if scope["type"] != "http":
+        await send({"type": "websocket.close", "code": 1000})
+        return
+    
+    debug_mode = DEBUG_MODE
+    method = scope["method"]
+    instance_name, target_url, host_header = resolve_target(scope["path"])
+    # Forward the already-encoded query string as-is
+    query_string = scope["query_string"]
+    if query_string:
+        target_url += "?" + query_string.decode("latin-1")
+    
+    # Prepare headers (exclude host and authorization) while picking out what we need
+    authorization = None
+    has_body = False
+    headers = []
+    for key, value in scope["headers"]:
+        if key == b"authorization":
+            authorization = value.decode("latin-1")
+        elif key == b"content-length" or key == b"transfer-encoding":
+            has_body = True
+        if key not in _REQ_DROP:
+            headers.append((key, value))
+    if host_header is not None:
+        headers.append((b"host", host_header))
+    
     try:
-        # Get request body
-        body = await request.body()
-        
-        # Check if the request is for streaming
-        is_stream_request = False
-        body_json = None
-        if body:
+        await verify_token(authorization)
+    except HTTPException as e:
+        error = JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+        await error(scope, receive, send)
+        return
+    
+    # Skip root and health endpoints (methods the FastAPI routes above don't take)
+    if scope["path"] in ("/", "/health"):
+        logger.debug("📍 Health check endpoint accessed: %s", scope["path"])
+        await JSONResponse({"status": "ok"})(scope, receive, send)
+        return
+    
+    async def request_body():
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnect()
+            more_body = message.get("more_body", False)
+            yield message.get("body", b"")
+    
+    # Forward the request body as it arrives instead of buffering it;
+    # requests without a body (e.g. GET /api/tags) send none upstream
+    body = request_body() if has_body else None
+    
+    # Log request details in debug mode
+    if debug_mode:
+        logger.debug(f"📤 Request details:")
+        logger.debug(f"   Method: {method}")
+        logger.debug(f"   URL: {target_url}")
+        if has_body:
+            # Debug mode reads the whole body so it can be logged
             try:
-                body_json = json.loads(body)
-                is_stream_request = body_json.get("stream", False)
-            except:
-                pass
-        
-        # Log request details in debug mode
-        if DEBUG_MODE:
-            logger.debug(f"📤 Request details:")
-            logger.debug(f"   Method: {request.method}")
-            logger.debug(f"   URL: {target_url}")
-            logger.debug(f"   Query params: {dict(request.query_params)}")
+                body = b"".join([chunk async for chunk in body])
+            except ClientDisconnect:
+                logger.debug("🔌 Client disconnected while sending the request body")
+                return
             logger.debug(f"   Body size: {len(body)} bytes")
+            # Ollama only uses "stream" as a top-level boolean, so a substring scan is enough
+            is_stream_request = b'"stream":true' in body or b'"stream": true' in body
             logger.debug(f"   Stream requested: {is_stream_request}")
             if body and len(body) < 1000:  # Only log small bodies
                 try:
-                    if body_json is None:
-                        body_json = json.loads(body)
-                    logger.debug(f"   Body: {json.dumps(body_json, indent=2)}")
+                    logger.debug(f"   Body: {orjson.dumps(orjson.loads(body), option=orjson.OPT_INDENT_2).decode()}")
                 except:
                     logger.debug(f"   Body (raw): {body[:200]}...")
-        
-        # Prepare headers (exclude host and authorization)
-        headers = {
-            key: value
-            for key, value in request.headers.items()
-            if key.lower() not in ["host", "authorization"]
-        }
-        
-        if DEBUG_MODE:
-            logger.debug(f"   Headers: {json.dumps(headers, indent=2)}")
-        
-        logger.info(f"🔄 Proxying {request.method} to '{instance_name}': {target_url}")
-        
-        # Make the request to Ollama with streaming if needed
-        if is_stream_request:
-            logger.debug("🌊 Initiating streaming request to Ollama")
-            
-            # Create a generator that manages its own client and stream
-            async def stream_generator():
-                chunk_count = 0
-                async with httpx.AsyncClient(timeout=300.0) as client:
-                    async with client.stream(
-                        method=request.method,
-                        url=target_url,
-                        content=body,
-                        headers=headers,
-                        params=request.query_params
-                    ) as response:
-                        logger.debug(f"📥 Response status: {response.status_code}")
-                        logger.debug(f"📥 Response headers: {dict(response.headers)}")
-                        
-                        # Stream the response immediately
-                        async for chunk in response.aiter_bytes():
-                            chunk_count += 1
-                            if DEBUG_MODE and chunk_count % 10 == 0:
-                                logger.debug(f"   Streamed {chunk_count} chunks so far...")
-                            yield chunk
-                        
-                        if DEBUG_MODE:
-                            logger.debug(f"✅ Streaming complete: {chunk_count} total chunks")
-            
-            # Return the streaming response immediately
-            return StreamingResponse(
-                stream_generator(),
-                media_type="application/json"
-            )
-        
-        # Non-streaming path
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            # Make regular non-streaming request
-            response = await client.request(
-                method=request.method,
-                url=target_url,
-                content=body,
-                headers=headers,
-                params=request.query_params
-            )
-            
-            logger.debug(f"📥 Response status: {response.status_code}")
-            
-            # Check if response is streaming (fallback for when stream param is not detected)
-            content_type = response.headers.get("content-type", "")
-            logger.debug(f"📥 Response content-type: {content_type}")
-            logger.debug("📄 Regular response (non-streaming)")
-            # Return regular response - pass through the raw content
-            try:
-                response_data = response.json() if response.text else {}
-                if DEBUG_MODE and response.text and len(response.text) < 1000:
-                    logger.debug(f"📥 Response body: {json.dumps(response_data, indent=2)}")
-            except Exception as e:
-                logger.warning(f"⚠️  Could not parse response as JSON: {e}")
-                # Return raw text if JSON parsing fails
-                response_data = {"raw_response": response.text}
-            
-            logger.info(f"✅ Request completed successfully: {response.status_code}")
-            
-            # Filter out hop-by-hop headers
-            response_headers = {
-                k: v for k, v in response.headers.items()
-                if k.lower() not in ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
-            }
-            
-            return JSONResponse(
-                content=response_data,
-                status_code=response.status_code,
-                headers=response_headers
-            )
+        debug_headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in headers}
+        logger.debug(f"   Headers: {orjson.dumps(debug_headers, option=orjson.OPT_INDENT_2).decode()}")
+    
+    logger.info(f"🔄 Proxying {method} to '{instance_name}': {target_url}")
+    
+    try:
+        client = scope["app"].state.client
+        upstream_request = client.build_request(
+            method=method,
+            url=target_url,
+            content=body,
+            headers=headers
+        )
+        response = await client.send(upstream_request, stream=True)
     
     except httpx.ConnectError as e:
         logger.error(f"❌ Connection error to {target_url}: {e}")
-        raise HTTPException(
-            status_code=502,
-            detail=f"Cannot connect to Ollama backend: {str(e)}"
-        )
+        error = JSONResponse({"detail": f"Cannot connect to Ollama backend: {str(e)}"}, status_code=502)
+        await error(scope, receive, send)
+        return
     except httpx.TimeoutException as e:
         logger.error(f"⏱️  Timeout connecting to {target_url}: {e}")
-        raise HTTPException(
-            status_code=504,
-            detail="Ollama backend timeout"
-        )
+        error = JSONResponse({"detail": "Ollama backend timeout"}, status_code=504)
+        await error(scope, receive, send)
+        return
+    except ClientDisconnect:
+        logger.debug("🔌 Client disconnected while sending the request body")
+        return
     except Exception as e:
         logger.error(f"❌ Error proxying request: {e}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Proxy error: {str(e)}"
-        )
+        error = JSONResponse({"detail": f"Proxy error: {str(e)}"}, status_code=500)
+        await error(scope, receive, send)
+        return
+    
+    if debug_mode:
+        logger.debug(f"📥 Response status: {response.status_code}")
+        logger.debug(f"📥 Response headers: {dict(response.headers)}")
+    
+    # Filter out hop-by-hop headers (ASGI requires lowercase header names)
+    response_headers = []
+    for key, value in response.headers.raw:
+        key = key.lower()
+        if key not in _RESP_DROP:
+            response_headers.append((key, value))
+    
+    # Pipe the raw (still encoded) bytes straight back to the client, and stop
+    # reading from the backend as soon as the client goes away
+    chunk_count = 0
+    response_complete = False
+    try:
+        async with anyio.create_task_group() as task_group:
+            async def watch_disconnect():
+                while (await receive())["type"] != "http.disconnect":
+                    pass
+                task_group.cancel_scope.cancel()
+            
+            task_group.start_soon(watch_disconnect)
+            
+            await send({
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": response_headers
+            })
+            try:
+                if debug_mode:
+                    async for chunk in response.aiter_raw():
+                        chunk_count += 1
+                        if chunk_count % 10 == 0:
+                            logger.debug(f"   Streamed {chunk_count} chunks so far...")
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                else:
+                    # Production loop: no counting or logging per chunk
+                    async for chunk in response.aiter_raw():
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            except httpx.HTTPError as e:
+                # Headers are already sent, so leave the response unfinished;
+                # the server then drops the connection and the client sees the truncation
+                logger.error(f"❌ Backend stream from {target_url} failed: {e!r}")
+                task_group.cancel_scope.cancel()
+                return
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            response_complete = True
+            
+            task_group.cancel_scope.cancel()
+    finally:
+        await response.aclose()
+    
+    # The stream only stops early when watch_disconnect cancelled it
+    if not response_complete:
+        logger.info(f"🔌 Client disconnected, closed backend stream for '{instance_name}': {target_url}")
+        if debug_mode:
+            logger.debug(f"   Streamed {chunk_count} chunks before disconnect")
+        return
+    
+    logger.info(f"✅ Request completed successfully: {response.status_code}")
+    if debug_mode:
+        logger.debug(f"✅ Streaming complete: {chunk_count} total chunks")
+
+
+# Everything that is not a FastAPI route above is handled by the raw proxy, including
+# the hot Ollama endpoints (/api/generate, /api/chat, /api/tags, ...). The mount skips
+# FastAPI's route matching and dependency injection, so they need no static routes
+app.mount("/", proxy_asgi)
 
 
 if __name__ == "__main__":
+    import importlib.util
     import uvicorn
     
     port = int(os.getenv("PORT", "8000"))
     host = os.getenv("HOST", "0.0.0.0")
     
+    # Use the C-accelerated event loop and HTTP parser when installed (uvloop is not
+    # available on Windows); otherwise let uvicorn pick its defaults
+    loop = "uvloop" if importlib.util.find_spec("uvloop") is not None else "auto"
+    http = "httptools" if importlib.util.find_spec("httptools") is not None else "auto"
+    
     logger.info(f"🚀 Starting Ollama Proxy Server")
     logger.info(f"   Host: {host}")
     logger.info(f"   Port: {port}")
     logger.info(f"   Debug: {DEBUG_MODE}")
+    logger.info(f"   Event loop: {loop}")
+    logger.info(f"   HTTP parser: {http}")
     logger.info(f"   Log Level: {logging.getLevelName(LOG_LEVEL)}")
     
     uvicorn.run(
         "main:app",
         host=host,
         port=port,
+        loop=loop,
+        http=http,
         reload=DEBUG_MODE,
         log_level="debug" if DEBUG_MODE else "info"
     )